@@ -9,6 +9,12 @@ import datetime
 import json
 from dotenv import load_dotenv
 import sys
+import time
+import tempfile
+import uuid
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 # Load environment variables from .env file
 load_dotenv()
@@ -25,6 +31,29 @@ INVOICE_GEN_API_KEY = os.getenv('INVOICE_GEN_API_KEY')
 # Gemini API credentials from environment variables
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
+# Seconds to wait on the Gemini and Invoice Generator APIs, so a hung call can't
+# hold a shared background worker or a Generate click indefinitely
+API_TIMEOUT = 30
+
+# Speculative background work: start extraction once the bill content has been
+# unchanged for this many seconds, and optionally pre-render the invoice PDF too
+SPECULATION_DELAY = float(os.getenv('SPECULATION_DELAY', '2'))
+SPECULATE_PDF = os.getenv('SPECULATE_PDF', '').lower() in ('1', 'true', 'yes')
+# Pre-rendered invoices left behind by sessions that ended without sending are
+# removed once they are older than this many seconds
+SPECULATIVE_PDF_DIR = os.path.join(tempfile.gettempdir(), 'billbot-invoices')
+SPECULATIVE_PDF_MAX_AGE = 3600
+# A pre-rendered invoice carries the number and dates of its render, so it is only
+# sent if it was started at most this many seconds ago and on the same day
+SPECULATIVE_PDF_MAX_REUSE_AGE = 60
+
+# Speculation hit rates and latency saved are logged here
+logger = logging.getLogger("billbot")
+# Streamlit reruns the script, so the handler is only added the first time
+if not logger.handlers:
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+    logger.propagate = False
 
 
 # Initialize the speech recognizer
@@ -41,6 +70,11 @@ if "bill_content" not in st.session_state:
     st.session_state.bill_content = ""
 if "currency" not in st.session_state:
     st.session_state.currency = "USD"
+if "speculation" not in st.session_state:
+    st.session_state.speculation = None
+if "stable_bill_content" not in st.session_state:
+    st.session_state.stable_bill_content = ""
+    st.session_state.bill_content_changed_at = time.perf_counter()
 
 # Language mapping for Google Speech Recognition
 language_map = {
@@ -133,7 +167,7 @@ def convert_number_words_to_digits(text, language):
 
 
 # Function to extract structured item details from Gemini API response
-def extract_item_details_from_gemini(bill_content):
+def extract_item_details_from_gemini(bill_content, report=st.write):
     """Extract structured item details from Gemini API."""
     prompt = f"Extract structured JSON for bill items, including item names, quantities, and prices from the following text: '{bill_content}'"
     
@@ -151,7 +185,7 @@ def extract_item_details_from_gemini(bill_content):
     }
     
     try:
-        response = requests.post(gemini_api_url, json=payload, headers=headers)
+        response = requests.post(gemini_api_url, json=payload, headers=headers, timeout=API_TIMEOUT)
         response.raise_for_status()
         data = response.json()
 
@@ -170,15 +204,15 @@ def extract_item_details_from_gemini(bill_content):
             structured_items = json.loads(cleaned_json)
             return structured_items
         except json.JSONDecodeError as e:
-            st.write(f"Error parsing JSON: {e}")
+            report(f"Error parsing JSON: {e}")
             return None
 
     except requests.exceptions.RequestException as e:
-        st.write(f"Error extracting item details: {e}")
+        report(f"Error extracting item details: {e}")
         return None
 
 # Function to generate an invoice using Invoice Generator API
-def generate_invoice_pdf(customer_name, customer_number, items, currency):
+def generate_invoice_pdf(customer_name, customer_number, items, currency, output_path="invoice.pdf", report=st.write):
     """Generate invoice PDF using Invoice Generator API."""
     
     current_date = datetime.datetime.now().strftime("%b %d, %Y")
@@ -215,7 +249,7 @@ def generate_invoice_pdf(customer_name, customer_number, items, currency):
             data[f"items[{i}][unit_cost]"] = item["price_per_item"]
         else:
             # Fallback if neither field is present
-            st.write("Warning: Price field not found in item data")
+            report("Warning: Price field not found in item data")
             data[f"items[{i}][unit_cost]"] = 0
 
     headers = {
@@ -224,15 +258,15 @@ def generate_invoice_pdf(customer_name, customer_number, items, currency):
     }
 
     try:
-        response = requests.post(INVOICE_GEN_API_URL, headers=headers, data=data)
+        response = requests.post(INVOICE_GEN_API_URL, headers=headers, data=data, timeout=API_TIMEOUT)
         response.raise_for_status()
         
-        with open("invoice.pdf", "wb") as f:
+        with open(output_path, "wb") as f:
             f.write(response.content)
         
-        return "invoice.pdf"
+        return output_path
     except requests.exceptions.RequestException as e:
-        st.write(f"Error generating invoice: {e}")
+        report(f"Error generating invoice: {e}")
         return None
 
 
@@ -265,13 +299,16 @@ def upload_to_tempfiles(file_path):
         
 
 def send_pdf_via_whatsapp(pdf_file, customer_number):
-    """Uploads the PDF to tempfiles.org and sends the generated PDF to the customer via WhatsApp."""
+    """Uploads the PDF to tempfiles.org and sends the generated PDF to the customer via WhatsApp.
+
+    Returns (sent, message) so callers can tell a delivered bill from an error.
+    """
     # Upload the PDF to tempfiles.org
     pdf_file_url = upload_to_tempfiles(pdf_file)
     st.write(pdf_file_url)
     
     if not pdf_file_url:
-        return "Error: Could not upload file to tempfiles.org."
+        return False, "Error: Could not upload file to tempfiles.org."
     
     client = Client(TWILIO_SID, TWILIO_AUTH_TOKEN)
 
@@ -282,9 +319,271 @@ def send_pdf_via_whatsapp(pdf_file, customer_number):
             media_url=[pdf_file_url],  # Use the tempfiles.org link here
             to=f'whatsapp:{customer_number}'
         )
-        return f"Bill successfully sent to {customer_number}"
+        return True, f"Bill successfully sent to {customer_number}"
     except Exception as e:
-        return f"Error sending bill via WhatsApp: {str(e)}"
+        return False, f"Error sending bill via WhatsApp: {str(e)}"
+
+
+# Shared worker pool for speculative extraction and PDF pre-rendering
+@st.cache_resource
+def get_speculation_executor():
+    """Return the thread pool used for background work across sessions."""
+    return ThreadPoolExecutor(max_workers=4)
+
+def run_in_background(func, *args):
+    """Run func on a pool thread and return (result, started_at, duration, messages).
+
+    Pool threads have no ScriptRunContext, so anything func would st.write is
+    collected in messages for the Generate click to show instead.
+    """
+    messages = []
+    started_at = time.perf_counter()
+    result = func(*args, report=messages.append)
+    return result, started_at, time.perf_counter() - started_at, messages
+
+def speculative_result(future, timeout=None):
+    """Wait for a speculative job and return (result, started_at, duration, messages), or (None, 0.0, 0.0, []) if it failed.
+
+    A job that is still running after timeout seconds counts as failed.
+    """
+    try:
+        if future.cancelled() or future.exception(timeout) is not None:
+            return None, 0.0, 0.0, []
+    except FutureTimeoutError:
+        return None, 0.0, 0.0, []
+    return future.result()
+
+def claim_speculative_result(future):
+    """Take a speculative job's (result, started_at, duration, messages) for the Generate click.
+
+    A job still queued behind other sessions' work is cancelled instead of
+    awaited, and a running one is given at most API_TIMEOUT seconds before the
+    click falls back to the synchronous call.
+    """
+    if future.cancel():
+        return None, 0.0, 0.0, []
+    return speculative_result(future, API_TIMEOUT)
+
+def completed_future(result):
+    """Wrap an already known result so it can stand in for a background job."""
+    future = Future()
+    future.set_result(result)
+    return future
+
+def remove_speculative_pdf(future):
+    """Delete the file a finished PDF pre-render wrote, if any."""
+    pdf_file, _, _, _ = speculative_result(future)
+    if pdf_file and os.path.exists(pdf_file):
+        os.remove(pdf_file)
+
+def prune_speculative_pdfs():
+    """Remove pre-rendered invoices that no session has used in a long time."""
+    cutoff = time.time() - SPECULATIVE_PDF_MAX_AGE
+    for name in os.listdir(SPECULATIVE_PDF_DIR):
+        path = os.path.join(SPECULATIVE_PDF_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            continue
+
+def new_speculation(bill_content, submitted_at, future, speculative):
+    """Return the state kept for the extraction of bill_content and its pre-rendered invoice.
+
+    speculative is False once future holds the items a Generate click extracted itself.
+    """
+    return {
+        "bill_content": bill_content,
+        "submitted_at": submitted_at,
+        "future": future,
+        "speculative": speculative,
+        "pdf_key": None,
+        "pdf_future": None,
+        "pdf_submitted_at": None,
+        "pdf_submitted_on": None,
+        "sent_pdf_key": None,
+    }
+
+def current_pdf_key():
+    """Return the form fields besides the items that a rendered invoice depends on."""
+    return (st.session_state.customer_name, st.session_state.customer_number, st.session_state.currency)
+
+def pdf_speculation_is_fresh(speculation, clicked_at):
+    """Tell whether the pre-rendered invoice is recent enough to send with its own number and dates."""
+    return (
+        clicked_at - speculation["pdf_submitted_at"] <= SPECULATIVE_PDF_MAX_REUSE_AGE
+        and speculation["pdf_submitted_on"] == datetime.date.today()
+    )
+
+def discard_pdf_speculation(speculation):
+    """Cancel a pending PDF pre-render and remove its file once it is written."""
+    pdf_future = speculation["pdf_future"]
+    if pdf_future is None:
+        return
+    # Runs straight away for a finished or cancelled render, otherwise when it completes
+    pdf_future.cancel()
+    pdf_future.add_done_callback(remove_speculative_pdf)
+    speculation["pdf_key"] = None
+    speculation["pdf_future"] = None
+    speculation["pdf_submitted_at"] = None
+    speculation["pdf_submitted_on"] = None
+
+def discard_speculation():
+    """Drop the current speculation; a job that is already running finishes and is ignored."""
+    speculation = st.session_state.speculation
+    if speculation is None:
+        return
+    speculation["future"].cancel()
+    discard_pdf_speculation(speculation)
+    st.session_state.speculation = None
+
+def update_speculation(submit=True):
+    """Start, keep or discard background work to match the current form contents.
+
+    With submit=False stale work is dropped but nothing new is started, so a
+    Generate click in the same rerun never waits on a job it just submitted.
+    """
+    now = time.perf_counter()
+    bill_content = st.session_state.bill_content
+    speculation = st.session_state.speculation
+
+    # Stale results are useless once the bill text changes
+    if speculation and speculation["bill_content"] != bill_content:
+        discard_speculation()
+        speculation = None
+
+    if st.session_state.stable_bill_content != bill_content:
+        st.session_state.stable_bill_content = bill_content
+        st.session_state.bill_content_changed_at = now
+        return
+
+    if not submit or not bill_content.strip():
+        return
+
+    executor = get_speculation_executor()
+
+    if speculation is None:
+        if now - st.session_state.bill_content_changed_at >= SPECULATION_DELAY:
+            future = executor.submit(run_in_background, extract_item_details_from_gemini, bill_content)
+            st.session_state.speculation = new_speculation(bill_content, now, future, True)
+        return
+
+    # Pre-render the invoice once the items and every other field are known
+    if not SPECULATE_PDF or not speculation["future"].done():
+        return
+    if not (st.session_state.customer_name and st.session_state.customer_number):
+        return
+    items, _, _, _ = speculative_result(speculation["future"])
+    if not items:
+        return
+    pdf_key = current_pdf_key()
+    # Never pre-render the invoice that was just sent
+    if pdf_key == speculation["sent_pdf_key"]:
+        return
+    # Keep a current pre-render; one too old to send is replaced like a changed one
+    if pdf_key == speculation["pdf_key"] and pdf_speculation_is_fresh(speculation, now):
+        return
+    discard_pdf_speculation(speculation)
+    os.makedirs(SPECULATIVE_PDF_DIR, exist_ok=True)
+    prune_speculative_pdfs()
+    output_path = os.path.join(SPECULATIVE_PDF_DIR, f"invoice-{uuid.uuid4().hex}.pdf")
+    speculation["pdf_key"] = pdf_key
+    speculation["pdf_submitted_at"] = now
+    speculation["pdf_submitted_on"] = datetime.date.today()
+    speculation["pdf_future"] = executor.submit(
+        run_in_background, generate_invoice_pdf, *pdf_key[:2], items, pdf_key[2], output_path
+    )
+
+# Fragment reruns don't wait for the operator to interact with the page
+@st.fragment(run_every=max(SPECULATION_DELAY, 0.5))
+def watch_bill_content():
+    """Start background work as soon as the bill content has settled."""
+    update_speculation()
+
+# Running speculation totals for every session served by this process
+@st.cache_resource
+def get_speculation_stats():
+    """Return the shared hit, miss and latency-saved totals and the lock guarding them."""
+    stats = {
+        "extraction": {"hits": 0, "misses": 0, "latency_saved": 0.0},
+        "pdf": {"hits": 0, "misses": 0, "latency_saved": 0.0},
+    }
+    return stats, threading.Lock()
+
+def record_speculation(stage, hit, duration=0.0, started_at=None, clicked_at=None):
+    """Record a speculation hit or miss and the latency it saved the Generate click."""
+    all_stats, lock = get_speculation_stats()
+    with lock:
+        stats = all_stats[stage]
+        if hit:
+            stats["hits"] += 1
+            # A job still running at click time only saved the part already done;
+            # time spent queued behind other sessions' jobs saved nothing
+            stats["latency_saved"] += min(duration, clicked_at - started_at)
+        else:
+            stats["misses"] += 1
+        hits, total, latency_saved = stats["hits"], stats["hits"] + stats["misses"], stats["latency_saved"]
+    logger.info(
+        "Background %s %s: %d/%d reused (%.0f%%), %.1fs saved",
+        stage, "hit" if hit else "miss", hits, total, 100 * hits / total, latency_saved,
+    )
+
+def claim_bill_items(clicked_at):
+    """Return the items for the current bill content, extracting them now unless the background job has them."""
+    bill_content = st.session_state.bill_content
+    speculation = st.session_state.speculation
+
+    # Reuse the background extraction when it was made for this exact text
+    structured_bill_content = None
+    if speculation and speculation["bill_content"] == bill_content:
+        # A failed extraction is simply redone below, where its errors are shown
+        structured_bill_content, started_at, duration, _ = claim_speculative_result(speculation["future"])
+    else:
+        speculation = None
+    if structured_bill_content:
+        if speculation["speculative"]:
+            record_speculation("extraction", True, duration, started_at, clicked_at)
+    else:
+        # Items a previous click failed to extract were never speculated on
+        if speculation is None or speculation["speculative"]:
+            record_speculation("extraction", False)
+        # Use Gemini to structure the bill content
+        structured_bill_content = extract_item_details_from_gemini(bill_content)
+
+    # Keep the items for this text so later reruns and clicks don't extract it again
+    future = completed_future((structured_bill_content, clicked_at, 0.0, []))
+    if speculation is None:
+        st.session_state.speculation = new_speculation(bill_content, clicked_at, future, False)
+    else:
+        speculation["future"] = future
+        speculation["speculative"] = False
+    return structured_bill_content
+
+def claim_invoice_pdf(speculation, items, clicked_at):
+    """Return the invoice for the current form, rendering it now unless the pre-rendered one matches."""
+    # Reuse the pre-rendered invoice when the customer details still match and its dates are current
+    pdf_key = current_pdf_key()
+    if (
+        speculation["pdf_future"]
+        and speculation["pdf_key"] == pdf_key
+        and pdf_speculation_is_fresh(speculation, clicked_at)
+    ):
+        pdf_file, started_at, duration, messages = claim_speculative_result(speculation["pdf_future"])
+        if pdf_file and os.path.exists(pdf_file):
+            for message in messages:
+                st.write(message)
+            record_speculation("pdf", True, duration, started_at, clicked_at)
+            return pdf_file
+
+    if SPECULATE_PDF and speculation["sent_pdf_key"] != pdf_key:
+        record_speculation("pdf", False)
+    # Generate invoice PDF
+    return generate_invoice_pdf(
+        st.session_state.customer_name,
+        st.session_state.customer_number,
+        items,
+        st.session_state.currency
+    )
 
 
     
@@ -642,28 +941,35 @@ _, center_col, _ = st.columns([1, 2, 1])
 with center_col:
     generate_btn = st.button("Generate and Send Bill", key="generate_button", use_container_width=True)
 
+# Drop background work made for text that has since changed
+update_speculation(submit=False)
+
 # Process the bill if button is clicked
 if generate_btn:
     if st.session_state.customer_name and st.session_state.customer_number and st.session_state.bill_content:
-        # Use Gemini to structure the bill content
-        structured_bill_content = extract_item_details_from_gemini(st.session_state.bill_content)
+        clicked_at = time.perf_counter()
+        structured_bill_content = claim_bill_items(clicked_at)
 
         if structured_bill_content:
-            # Generate invoice PDF
-            pdf_file = generate_invoice_pdf(
-                st.session_state.customer_name,
-                st.session_state.customer_number,
-                structured_bill_content,
-                st.session_state.currency
-            )
+            speculation = st.session_state.speculation
+            pdf_file = claim_invoice_pdf(speculation, structured_bill_content, clicked_at)
 
             if pdf_file:
-                result = send_pdf_via_whatsapp(pdf_file, st.session_state.customer_number)
-                st.markdown(f"<div class='success'>{result}</div>", unsafe_allow_html=True)
+                sent, result = send_pdf_via_whatsapp(pdf_file, st.session_state.customer_number)
+                if sent:
+                    speculation["sent_pdf_key"] = current_pdf_key()
+                    st.markdown(f"<div class='success'>{result}</div>", unsafe_allow_html=True)
+                else:
+                    st.markdown(f"<div class='error'>{result}</div>", unsafe_allow_html=True)
             else:
                 st.markdown("<div class='error'>Error: Could not generate invoice PDF.</div>", unsafe_allow_html=True)
+
+            # A sent invoice must not be sent again as-is; the next click renders a fresh one
+            discard_pdf_speculation(speculation)
         else:
             st.markdown("<div class='error'>Error: Could not extract structured content from bill text.</div>", unsafe_allow_html=True)
     else:
         st.markdown("<div class='error'>Please fill in all required fields: Customer Name, Customer Number, and Bill Content.</div>", unsafe_allow_html=True)
 
+# Keep background extraction in step with the bill content on a timer
+watch_bill_content()